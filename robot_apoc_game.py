@@ -1,12 +1,18 @@
+import io
 import os
 import sys
+import asyncio
+import copy
 import re
+import gzip
 import json
 import logging
-import argparse
 import textwrap
+import threading
+from collections import deque
 
-import openai
+import msgpack
+import orjson
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -15,14 +21,26 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+# 摘要用：連續換行壓成一個
+_NEWLINES_RE = re.compile(r"\n+")
+
+# LLM 回應修復用：Markdown code fence，以及只解析第一個 JSON 物件
+_FENCE_RE = re.compile(r"^```(?:json)?|```$", re.M)
+_JSON_DECODER = json.JSONDecoder()
+
 
 # ========== 基礎 I/O 工具 ==========
 
+def _dumps(obj) -> str:
+    # orjson 一律輸出 UTF-8，等同 json.dumps(..., ensure_ascii=False)
+    return orjson.dumps(obj).decode("utf-8")
+
+
 def read_json(file, write_log=False):
     if write_log:
         logger.info(f"Reading {file}")
-    with open(file, "r", encoding="utf8") as f:
-        data = json.load(f)
+    with open(file, "rb") as f:
+        data = orjson.loads(f.read())
     if write_log:
         if isinstance(data, dict):
             logger.info(f"Read dict with {len(data)} keys")
@@ -37,8 +55,35 @@ def write_json(file, data, indent=None, write_log=False):
             logger.info(f"Writing dict with {len(data)} keys to {file}")
         elif isinstance(data, list):
             logger.info(f"Writing list with {len(data)} elements to {file}")
-    with open(file, "w", encoding="utf8") as f:
-        json.dump(data, f, indent=indent, ensure_ascii=False)
+    # orjson 只支援 2 格縮排
+    option = orjson.OPT_INDENT_2 if indent else 0
+    with open(file, "wb") as f:
+        f.write(orjson.dumps(data, option=option))
+    if write_log:
+        logger.info("Written")
+
+
+def read_msgpack_gz(file, write_log=False):
+    if write_log:
+        logger.info(f"Reading {file}")
+    with gzip.open(file, "rb") as f:
+        data = msgpack.unpackb(f.read(), raw=False)
+    if write_log:
+        if isinstance(data, dict):
+            logger.info(f"Read dict with {len(data)} keys")
+        elif isinstance(data, list):
+            logger.info(f"Read list with {len(data)} elements")
+    return data
+
+
+def write_msgpack_gz(file, data, write_log=False):
+    if write_log:
+        if isinstance(data, dict):
+            logger.info(f"Writing dict with {len(data)} keys to {file}")
+        elif isinstance(data, list):
+            logger.info(f"Writing list with {len(data)} elements to {file}")
+    with gzip.open(file, "wb") as f:
+        f.write(msgpack.packb(data, use_bin_type=True))
     if write_log:
         logger.info("Written")
 
@@ -52,12 +97,69 @@ def write_txt(file, text, write_log=False):
         logger.info("Written")
 
 
+def parse_llm_json(out: str):
+    # LLM 偶爾會包 Markdown code fence 或在後面多講幾句：先直接 parse，失敗再修一次
+    try:
+        return orjson.loads(out)
+    except orjson.JSONDecodeError:
+        pass
+    text = _FENCE_RE.sub("", out.strip())
+    start = text.find("{")
+    if start == -1:
+        return orjson.loads(text)
+    # orjson 沒有 raw_decode：用 stdlib 解到第一個物件結束為止，後面的廢話不管
+    return _JSON_DECODER.raw_decode(text, start)[0]
+
+
+async def ainput(prompt: str = "") -> str:
+    # input() 會卡住 event loop，放到 daemon thread 讀；
+    # 不用 executor，否則 Ctrl+C 時 asyncio.run 會等到玩家按 ENTER 才結束
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(set_value, value):
+        if not future.done():
+            set_value(value)
+
+    def read():
+        try:
+            text = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, text)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # 給不再 await 的 task 當 done callback，只是把例外標成已讀取
+    if not task.cancelled():
+        task.exception()
+
+
 def print_box(text: str):
     print("\n" + "\n".join(textwrap.wrap(str(text), width=70)) + "\n")
 
 
 # ========== Config：全部從 config.json 讀 ==========
 
+# 每個模板會被填入的欄位
+PROMPT_FIELDS = {
+    # 不提供整張地圖：LLM 只需要目前房間，移動選項由程式產生
+    "explore": ("state_json", "action_text", "room_json"),
+    "quiz": ("state_json",),
+}
+
+
+def compile_prompt(tmpl: str, fields) -> str:
+    # 模板裡有 JSON 範例的大括號：全部跳脫，只保留要填的欄位給 format_map
+    escaped = tmpl.replace("{", "{{").replace("}", "}}")
+    pattern = r"\{\{(" + "|".join(map(re.escape, fields)) + r")\}\}"
+    return re.sub(pattern, r"{\1}", escaped)
+
+
 class Config:
     def __init__(self, config_file: str):
         data = read_json(config_file, write_log=True)
@@ -67,37 +169,183 @@ class Config:
         self.prompts = data["prompts"]   # start / opening / explore / quiz / ending
         self.rooms = data["rooms"]       # 地圖：每個房間 + connections
 
+        # explore / quiz 模板先轉成 format_map 用的格式（每回合只掃一次模板）
+        self.compiled_prompts = {
+            name: compile_prompt(self.prompts.get(name, ""), fields)
+            for name, fields in PROMPT_FIELDS.items()
+        }
+
         # 所有輸出都放在 lab2_output 底下
         self.output_dir = "lab2_output"
         os.makedirs(self.output_dir, exist_ok=True)
 
+        # 地圖整局不變：每個房間的 JSON 字串只序列化一次
+        self.room_json = {k: _dumps(v) for k, v in self.rooms.items()}
+
+        # 移動選項只跟所在位置有關：先算好
+        # 顯示名稱可以自己美化，這裡先顯示房間 key
+        self.moves_by_location = {
+            loc: [{"id": f"move_{c}", "text": f"前往 {c}"} for c in info.get("connections", [])]
+            for loc, info in self.rooms.items()
+        }
+
+        # 檢查移動是否合法用
+        self.valid_moves = {
+            loc: frozenset(info.get("connections", []))
+            for loc, info in self.rooms.items()
+        }
+
 
 # ========== GPT 包裝：使用舊版 ChatCompletion API ==========
 
+def make_requests_session():
+    # requests 載入較慢，用到才 import
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # 給同步的 File / batches 呼叫用（acreate 走 aiohttp，不經過這裡）
+    # 整局共用一個 keep-alive 連線池，429 / 5xx 自動退避重試
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST"]),
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
 class GPT:
     def __init__(self, model: str):
         # 若 config 沒給就 fallback gpt-3.5-turbo
         self.model = model or "gpt-3.5-turbo"
 
-    def run(self, prompt: str, max_tokens: int = 800) -> str:
-        logger.info("Calling OpenAI ChatCompletion...")
-        resp = openai.ChatCompletion.create(
+        # openai 會連帶載入 requests / aiohttp 等，延後到建立 GPT 時才 import
+        import openai
+        self._openai = openai
+
+    def set_aiosession(self, session):
+        # 讓 acreate 共用同一個 aiohttp session
+        self._openai.aiosession.set(session)
+
+    async def run_async(self, prompt: str, max_tokens: int = 800,
+                        max_retries: int = 3) -> str:
+        # acreate 走 aiohttp，沒有 requests session 的 Retry：429 / 5xx 在這裡退避重試
+        error = self._openai.error
+        retryable = (
+            error.RateLimitError,
+            error.ServiceUnavailableError,
+            error.APIError,
+            error.APIConnectionError,
+            error.Timeout,
+        )
+        for attempt in range(max_retries + 1):
+            try:
+                return await self._run_async_once(prompt, max_tokens)
+            except retryable as e:
+                if attempt == max_retries:
+                    raise
+                delay = 0.5 * 2 ** attempt
+                logger.warning(f"OpenAI call failed ({e}), retry in {delay}s")
+                await asyncio.sleep(delay)
+
+    async def _run_async_once(self, prompt: str, max_tokens: int) -> str:
+        logger.info("Calling OpenAI ChatCompletion (async)...")
+        # stream=True：token 一到就收，不必等整段生成完
+        resp = await self._openai.ChatCompletion.acreate(
             model=self.model,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=max_tokens,
             n=1,
+            stream=True,
         )
-        return resp["choices"][0]["message"]["content"]
+        parts = []
+        async for chunk in resp:
+            parts.append(chunk["choices"][0]["delta"].get("content") or "")
+        return "".join(parts)
+
+    # Batch API：不需要即時回應的呼叫（例如結局摘要），費用約一半
+    def _batch_request(self, method: str, url: str, params: dict | None = None) -> dict:
+        # 0.x SDK 沒有 openai.Batch：直接用 APIRequestor 打 /v1/batches
+        requestor = self._openai.api_requestor.APIRequestor()
+        resp, _, _ = requestor.request(method, url, params=params)
+        return resp.data
+
+    def submit_batch(self, custom_id: str, prompt: str, max_tokens: int = 800) -> str:
+        line = _dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.model,
+                "messages": [{"role": "user", "content": prompt}],
+                "max_tokens": max_tokens,
+                "n": 1,
+            },
+        })
+        logger.info("Submitting OpenAI Batch...")
+        batch_input = self._openai.File.create(
+            file=io.BytesIO((line + "\n").encode("utf8")),
+            purpose="batch",
+        )
+        try:
+            batch = self._batch_request("post", "/batches", {
+                "input_file_id": batch_input["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            })
+        except Exception:
+            # 建立失敗就把剛上傳的檔案刪掉
+            try:
+                self._openai.File.delete(batch_input["id"])
+            except Exception as e:
+                logger.error(f"Failed to delete batch input file: {e}")
+            raise
+        return batch["id"]
+
+    def fetch_batch(self, batch_id: str) -> str | None:
+        # 還沒跑完回傳 None；失敗 / 過期則丟例外
+        batch = self._batch_request("get", f"/batches/{batch_id}")
+        status = batch["status"]
+        if status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Batch {batch_id} {status}")
+        if status != "completed":
+            return None
+        content = self._openai.File.download(batch["output_file_id"])
+        result = orjson.loads(content.splitlines()[0])
+        return result["response"]["body"]["choices"][0]["message"]["content"]
 
 
 # ========== 遊戲 State ==========
 
+# 給 LLM 看的 state 欄位（存檔另外再加日誌與結束狀態）
+PROMPT_STATE_KEYS = (
+    "turn",
+    "chapter",
+    "location",
+    "profession",
+    "level",
+    "hp",
+    "knowledge_score",
+    "robot_parts",
+    "flags",
+    "inventory",
+    "danger_level",
+)
+
+
 class State:
     def __init__(self, save_file: str = ""):
         self.save_file = save_file
 
-        # 日誌（之後拿來做 summary）
-        self.log = ""
+        # 日誌（之後拿來做 summary）：只保留最近幾回合的原文，
+        # 更早的內容由 LLM 併進 running_summary，總結的 prompt 長度不會一直變大
+        self.running_summary = ""
+        self.pending_fold: list[str] = []   # 已移出視窗、還沒併進摘要的原文
+        self.recent_turns: deque[str] = deque(maxlen=10)
 
         # 進度
         self.turn = 0
@@ -129,34 +377,80 @@ class State:
         self.is_game_over = False
         self.is_win = False
 
+    def append_log(self, text: str, new_turn: bool = False) -> bool:
+        # new_turn=True 開一個新的回合；其餘接在目前回合後面
+        # 回傳是否有回合被移出視窗
+        evicted = False
+        if new_turn or not self.recent_turns:
+            if len(self.recent_turns) == self.recent_turns.maxlen:
+                self.pending_fold.append(self.recent_turns[0])
+                evicted = True
+            self.recent_turns.append(text)
+        else:
+            self.recent_turns[-1] += text
+        return evicted
+
+    @property
+    def log(self) -> str:
+        return "\n".join(filter(None, [
+            self.running_summary,
+            "".join(self.pending_fold),
+            "".join(self.recent_turns),
+        ]))
+
+    def snapshot(self):
+        # 複製給 LLM 看的欄位（不含日誌 / 存檔），用來猜下一回合
+        snap = State()
+        for k, v in self.prompt_dict().items():
+            setattr(snap, k, copy.deepcopy(v))
+        return snap
+
+    def prompt_dict(self):
+        return {k: self.__dict__[k] for k in PROMPT_STATE_KEYS}
+
+    def state_json(self) -> str:
+        return _dumps(self.prompt_dict())
+
     def to_dict(self):
         return {
-            "log": self.log,
-            "turn": self.turn,
-            "chapter": self.chapter,
-            "location": self.location,
-            "profession": self.profession,
-            "level": self.level,
-            "hp": self.hp,
-            "knowledge_score": self.knowledge_score,
-            "robot_parts": self.robot_parts,
-            "flags": self.flags,
-            "inventory": self.inventory,
-            "danger_level": self.danger_level,
+            "running_summary": self.running_summary,
+            "pending_fold": self.pending_fold,
+            "recent_turns": list(self.recent_turns),
+            **self.prompt_dict(),
             "is_game_over": self.is_game_over,
             "is_win": self.is_win,
         }
 
+    # 存檔用 msgpack + gzip；舊版的 .json 存檔仍可讀取
+    @property
+    def legacy_save_file(self):
+        return os.path.splitext(self.save_file)[0] + ".json"
+
+    def exists(self):
+        if not self.save_file:
+            return False
+        return os.path.exists(self.save_file) or os.path.exists(self.legacy_save_file)
+
     def save(self):
         if not self.save_file:
             return
-        write_json(self.save_file, self.to_dict(), indent=2, write_log=True)
+        write_msgpack_gz(self.save_file, self.to_dict(), write_log=True)
 
     def load(self):
-        if not self.save_file or not os.path.exists(self.save_file):
+        if not self.save_file:
+            return
+        if os.path.exists(self.save_file):
+            data = read_msgpack_gz(self.save_file, write_log=True)
+        elif os.path.exists(self.legacy_save_file):
+            data = read_json(self.legacy_save_file, write_log=True)
+        else:
             return
-        data = read_json(self.save_file, write_log=True)
-        self.log = data.get("log", "")
+        self.running_summary = data.get("running_summary", "")
+        self.pending_fold = data.get("pending_fold", [])
+        # 舊版存檔只有完整的 log 字串：當成一個回合
+        log = data.get("log", "")
+        self.recent_turns.clear()
+        self.recent_turns.extend(data.get("recent_turns", [log] if log else []))
         self.turn = data.get("turn", 0)
         self.chapter = data.get("chapter", 1)
         self.location = data.get("location", "bunker_entrance")
@@ -177,6 +471,57 @@ class State:
         self.is_win = data.get("is_win", False)
 
 
+# ========== 更新 State：依固定的 schema 產生專用函式 ==========
+
+def build_state_updater(robot_part_keys):
+    # robot_parts 的 key 在開局就固定，直接展開成一行一行的程式碼
+    robot_part_lines = [
+        f"    if {k!r} in robot_parts and isinstance(rp.get({k!r}), bool):\n"
+        f"        robot_parts[{k!r}] = rp[{k!r}]\n"
+        for k in robot_part_keys
+    ]
+    src = (
+        "def apply_state_update(state, hint, quiz_result):\n"
+        # 完全忽略 hint["location"]，避免 LLM 瞬間移動
+        "    hint.pop('location', None)\n"
+        "    chapter = hint.get('chapter')\n"
+        "    if chapter:\n"
+        "        state.chapter = int(chapter)\n"
+        "    rp = hint.get('robot_parts') or {}\n"
+        "    robot_parts = state.robot_parts\n"
+        + "".join(robot_part_lines) +
+        # 存檔裡可能有沒展開到的 key：照原本的方式逐一處理
+        "    if rp:\n"
+        "        for k in rp.keys() - BAKED_KEYS:\n"
+        "            if k in robot_parts and isinstance(rp[k], bool):\n"
+        "                robot_parts[k] = rp[k]\n"
+        "    flags = hint.get('flags')\n"
+        "    if flags:\n"
+        "        state.flags.update(flags)\n"
+        "    inventory = state.inventory\n"
+        "    for item in hint.get('inventory_add') or ():\n"
+        "        if item not in inventory:\n"
+        "            inventory.append(item)\n"
+        "    danger = state.danger_level + int(hint.get('danger_delta') or 0)\n"
+        "    state.danger_level = max(0, min(100, danger))\n"
+        "    knowledge = state.knowledge_score + int(hint.get('knowledge_delta') or 0)\n"
+        "    hp = state.hp\n"
+        # quiz 額外處理
+        "    if quiz_result == 'correct':\n"
+        "        knowledge += 1\n"
+        "    elif quiz_result == 'wrong':\n"
+        "        hp -= 1\n"
+        "    state.knowledge_score = knowledge\n"
+        "    state.hp = hp + int(hint.get('hp_delta') or 0)\n"
+        # 升級規則（簡單版）
+        "    if knowledge in (3, 6):\n"
+        "        state.level += 1\n"
+    )
+    namespace = {"BAKED_KEYS": frozenset(robot_part_keys)}
+    exec(compile(src, "<apply_state_update>", "exec"), namespace)
+    return namespace["apply_state_update"]
+
+
 # ========== 主 Game 類別 ==========
 
 class Game:
@@ -187,17 +532,38 @@ class Game:
         self.rooms = config.rooms
         self.output_dir = config.output_dir
 
+        # 地圖相關的預算結果（Config 算好）
+        self._room_json_cache = config.room_json
+        self._moves_by_location = config.moves_by_location
+        self._valid_moves = config.valid_moves
+
+        # 套用 LLM state_update_hint 的專用函式
+        self._apply_state_update = build_state_updater(State().robot_parts.keys())
+
         self.max_saves = 4
         self.state = State()
         self.summary_file = ""
 
+        # 摘要走 Batch API：結局時最多等幾秒，沒完成就下次啟動再補寫
+        self.summary_batch_wait = 10
+
         # 給 LLM 用
         self.last_action_id = ""
         self.last_free_text = ""
 
+        # 下一回合的 LLM 呼叫（asyncio.Task）
+        self._next_turn_task = None
+        # 玩家輸入前先送出的猜測呼叫：(prompt, asyncio.Task)
+        self._speculative_turn = None
+
+        # 背景把移出視窗的日誌併進 running_summary（asyncio.Task）
+        self._fold_task = None
+
     # ---------- 遊戲開始 ----------
 
     def run_start(self):
+        self.collect_pending_summaries()
+
         # 讀 start prompt
         start_prompt = self.prompts.get(
             "start",
@@ -218,8 +584,8 @@ class Game:
         saveid_to_exist = {}
         for i in range(self.max_saves):
             save_id = str(i + 1)
-            save_file = os.path.join(self.output_dir, f"save_{save_id}.json")
-            if os.path.exists(save_file):
+            save_file = os.path.join(self.output_dir, f"save_{save_id}.mpz")
+            if State(save_file).exists():
                 saveid_to_exist[save_id] = True
                 save_list_text += f"({save_id}) 舊有存檔\n"
             else:
@@ -238,7 +604,7 @@ class Game:
                     use_save_id = text_in
                     break
 
-        save_file = os.path.join(self.output_dir, f"save_{use_save_id}.json")
+        save_file = os.path.join(self.output_dir, f"save_{use_save_id}.mpz")
         self.summary_file = os.path.join(self.output_dir, f"summary_{use_save_id}.txt")
         self.state = State(save_file)
 
@@ -246,12 +612,21 @@ class Game:
             self.choose_profession()
             opening = self.prompts.get("opening", "世界末日，你在地下室醒來……")
             input(opening + "\n(按 ENTER 開始冒險)... ")
-            self.state.log += opening + "\n"
+            self.add_log(opening + "\n", new_turn=True)
             self.state.save()
         else:
             self.state.load()
 
-        self.run_loop()
+        asyncio.run(self.run_game_async())
+
+    async def run_game_async(self):
+        # async 呼叫（acreate）同樣共用一個 keep-alive 連線池
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=4)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.gpt.set_aiosession(session)
+            await self.run_loop_async()
 
     def choose_profession(self):
         text = (
@@ -276,23 +651,96 @@ class Game:
 
     # ---------- 主 loop ----------
 
-    def run_loop(self):
+    @staticmethod
+    def turn_mode(turn: int) -> str:
+        # 60% explore, 40% quiz（簡單用 turn 控）
+        if turn % 3 == 0:
+            return "quiz"
+        return "explore"
+
+    def build_turn_prompt(self, mode: str, state: State, action_text: str) -> str:
+        if mode == "quiz":
+            return self.config.compiled_prompts["quiz"].format_map({
+                "state_json": state.state_json(),
+            })
+        return self.config.compiled_prompts["explore"].format_map({
+            "state_json": state.state_json(),
+            "action_text": action_text,
+            "room_json": self._room_json_cache.get(state.location, "{}"),
+        })
+
+    async def _request_turn(self, mode: str, prompt: str):
+        if mode == "quiz":
+            return await self.run_quiz_turn(prompt)
+        return await self.run_explore_turn(prompt)
+
+    def _start_next_turn(self):
+        self.state.turn += 1
+
+        mode = self.turn_mode(self.state.turn)
+        prompt = self.build_turn_prompt(mode, self.state, self.last_action_id or "")
+
+        # 猜中了（prompt 完全相同）就直接用已經送出的呼叫
+        spec = self._speculative_turn
+        if spec is not None and spec[0] == prompt:
+            self._speculative_turn = None
+            logger.info("Speculative turn hit")
+            return spec[1]
+        self._cancel_speculative_turn()
+
+        return asyncio.create_task(self._request_turn(mode, prompt))
+
+    def _speculate_next_turn(self, turn_data):
+        # 玩家還在看敘事、做選擇時，先猜這回合結束後的 state，把下一回合送出去
+        next_turn = self.state.turn + 1
+        mode = self.turn_mode(next_turn)
+
+        quiz = turn_data.get("quiz") if turn_data.get("mode") == "quiz" else None
+        if quiz:
+            # 假設玩家答對
+            correct = str(quiz.get("correct", "")).upper()
+            action_text = f"quiz_answer_{correct}"
+            quiz_result = "correct"
+        elif mode == "quiz":
+            # quiz 的 prompt 不含上一個動作，只要玩家沒移動就猜得中
+            action_text = ""
+            quiz_result = None
+        else:
+            # 下一回合 explore 要看玩家選了什麼，猜不到
+            return
+
+        snapshot = self.state.snapshot()
+        hint = copy.deepcopy(turn_data.get("state_update_hint") or {})
+        if not isinstance(hint, dict):
+            hint = {}
+        self._apply_state_update(snapshot, hint, quiz_result)
+        if all(snapshot.robot_parts.values()) or snapshot.hp <= 0:
+            return
+        snapshot.turn = next_turn
+
+        prompt = self.build_turn_prompt(mode, snapshot, action_text)
+        task = asyncio.create_task(self._request_turn(mode, prompt))
+        self._speculative_turn = (prompt, task)
+
+    def _cancel_speculative_turn(self):
+        if self._speculative_turn is None:
+            return
+        task = self._speculative_turn[1]
+        self._speculative_turn = None
+        # 丟掉的 task 可能已經失敗：把例外取走，不然會印 "Task exception was never retrieved"
+        task.add_done_callback(_retrieve_exception)
+        task.cancel()
+
+    async def run_loop_async(self):
+        if not (self.state.is_game_over or self.state.is_win):
+            self._next_turn_task = self._start_next_turn()
+
         while True:
             if self.state.is_game_over or self.state.is_win:
                 break
 
-            self.state.turn += 1
-
-            # 60% explore, 40% quiz（簡單用 turn 控）
-            if self.state.turn % 3 == 0:
-                mode = "quiz"
-            else:
-                mode = "explore"
-
-            if mode == "quiz":
-                turn_data = self.run_quiz_turn()
-            else:
-                turn_data = self.run_explore_turn()
+            turn_data = await self._next_turn_task
+            self._next_turn_task = None
 
             if not turn_data:
                 print_box("LLM 回應解析失敗，遊戲結束 QQ")
@@ -302,7 +750,7 @@ class Game:
             narration = turn_data.get("narration", "")
             print_box(f"[回合 {self.state.turn}]")
             print_box(narration)
-            self.state.log += f"\n[Turn {self.state.turn}]\n{narration}\n"
+            self.add_log(f"\n[Turn {self.state.turn}]\n{narration}\n", new_turn=True)
 
             # 媒體 prompt
             media = turn_data.get("media") or {}
@@ -313,12 +761,14 @@ class Game:
             if aud_p:
                 print_box("🎵 音效/音樂生成提示：\n" + aud_p)
 
+            self._speculate_next_turn(turn_data)
+
             quiz_result = None
 
             if turn_data.get("mode") == "quiz" and turn_data.get("quiz"):
-                quiz_result = self.handle_quiz(turn_data)
+                quiz_result = await self.handle_quiz(turn_data)
             else:
-                self.handle_explore(turn_data)
+                await self.handle_explore(turn_data)
 
             # 更新 state（不信任 LLM 的 location）
             state_hint = turn_data.get("state_update_hint") or {}
@@ -344,41 +794,21 @@ class Game:
             # 存檔
             self.state.save()
 
+            # 這回合的 state 已確定：下一回合的 LLM 呼叫先送出（或沿用猜中的）
+            if not (self.state.is_game_over or self.state.is_win):
+                self._next_turn_task = self._start_next_turn()
+
+        self._cancel_speculative_turn()
+
         # 結局 + 摘要
-        self.do_ending()
+        await self.do_ending()
 
     # ---------- LLM: explore 回合（只敘事 + 非移動互動） ----------
 
-    def run_explore_turn(self):
-        tmpl = self.prompts.get("explore", "")
-        room_info = self.rooms.get(self.state.location, {})
-        rooms_json = json.dumps(self.rooms, ensure_ascii=False)
-
-        state_json = json.dumps({
-            "turn": self.state.turn,
-            "chapter": self.state.chapter,
-            "location": self.state.location,
-            "profession": self.state.profession,
-            "level": self.state.level,
-            "hp": self.state.hp,
-            "knowledge_score": self.state.knowledge_score,
-            "robot_parts": self.state.robot_parts,
-            "flags": self.state.flags,
-            "inventory": self.state.inventory,
-            "danger_level": self.state.danger_level,
-        }, ensure_ascii=False)
-
-        room_json = json.dumps(room_info, ensure_ascii=False)
-        action_text = self.last_action_id or ""
-
-        prompt = tmpl.replace("{state_json}", state_json)\
-                     .replace("{action_text}", action_text)\
-                     .replace("{room_json}", room_json)\
-                     .replace("{rooms_json}", rooms_json)
-
-        out = self.gpt.run(prompt, max_tokens=800)
+    async def run_explore_turn(self, prompt: str):
+        out = await self.gpt.run_async(prompt, max_tokens=800)
         try:
-            turn_data = json.loads(out)
+            turn_data = parse_llm_json(out)
         except json.JSONDecodeError:
             logger.error("Explore JSON parse error")
             logger.error(out)
@@ -403,26 +833,10 @@ class Game:
 
     # ---------- LLM: quiz 回合 ----------
 
-    def run_quiz_turn(self):
-        tmpl = self.prompts.get("quiz", "")
-        state_json = json.dumps({
-            "turn": self.state.turn,
-            "chapter": self.state.chapter,
-            "location": self.state.location,
-            "profession": self.state.profession,
-            "level": self.state.level,
-            "hp": self.state.hp,
-            "knowledge_score": self.state.knowledge_score,
-            "robot_parts": self.state.robot_parts,
-            "flags": self.state.flags,
-            "inventory": self.state.inventory,
-            "danger_level": self.state.danger_level,
-        }, ensure_ascii=False)
-
-        prompt = tmpl.replace("{state_json}", state_json)
-        out = self.gpt.run(prompt, max_tokens=800)
+    async def run_quiz_turn(self, prompt: str):
+        out = await self.gpt.run_async(prompt, max_tokens=800)
         try:
-            turn_data = json.loads(out)
+            turn_data = parse_llm_json(out)
         except json.JSONDecodeError:
             logger.error("Quiz JSON parse error")
             logger.error(out)
@@ -437,25 +851,18 @@ class Game:
     # ---------- 產生「移動選項」：完全由程式根據 connections 決定 ----------
 
     def get_movement_choices(self):
-        room = self.rooms.get(self.state.location, {})
-        conns = room.get("connections", [])
-        moves = []
-        for conn in conns:
-            # 顯示名稱可以自己美化，這裡先顯示房間 key
-            text = f"前往 {conn}"
-            moves.append({"id": f"move_{conn}", "text": text})
-        return moves
+        return self._moves_by_location.get(self.state.location, [])
 
     # ---------- 處理 quiz ----------
 
-    def handle_quiz(self, turn_data):
+    async def handle_quiz(self, turn_data):
         q = turn_data["quiz"]
         print_box("[教學題] " + q["question"])
         for key, text in q["options"].items():
             print(f"  {key}. {text}")
 
         while True:
-            ans = input("\n你的選擇 (A/B/C/D)，或輸入 S 存檔：").strip().upper()
+            ans = (await ainput("\n你的選擇 (A/B/C/D)，或輸入 S 存檔：")).strip().upper()
             if ans == "S":
                 self.state.save()
                 continue
@@ -473,12 +880,12 @@ class Game:
 
         self.last_action_id = f"quiz_answer_{ans}"
         self.last_free_text = ""
-        self.state.log += f"\n[Quiz] Q: {q['question']}\nAns: {ans}, Correct: {correct}\n"
+        self.add_log(f"\n[Quiz] Q: {q['question']}\nAns: {ans}, Correct: {correct}\n")
         return quiz_result
 
     # ---------- 處理 explore：LLM 選項 + 程式產生的移動選項 ----------
 
-    def handle_explore(self, turn_data):
+    async def handle_explore(self, turn_data):
         llm_choices = turn_data.get("choices") or []
         move_choices = self.get_movement_choices()
 
@@ -499,7 +906,7 @@ class Game:
 
         chosen = None
         while True:
-            sel = input("\n你的選擇：").strip()
+            sel = (await ainput("\n你的選擇：")).strip()
             if sel.upper() == "S":
                 self.state.save()
                 continue
@@ -522,125 +929,191 @@ class Game:
         if cid.startswith("move_"):
             new_loc = cid.replace("move_", "")
             # 檢查是否真的是合法連接
-            room = self.rooms.get(self.state.location, {})
-            if new_loc in room.get("connections", []):
+            if new_loc in self._valid_moves.get(self.state.location, frozenset()):
                 old_loc = self.state.location
                 self.state.location = new_loc
                 self.last_action_id = cid
                 self.last_free_text = ""
-                self.state.log += f"\n[移動] 從 {old_loc} 前往 {new_loc}\n"
+                self.add_log(f"\n[移動] 從 {old_loc} 前往 {new_loc}\n")
             else:
                 # 理論上不會發生，安全起見防一下
-                self.state.log += f"\n[移動失敗] 無效連接 {cid}\n"
+                self.add_log(f"\n[移動失敗] 無效連接 {cid}\n")
             return
 
         # 若是自由輸入行動
         if cid == "free_action":
-            free_text = input("請自由描述你想做的行動：")
+            free_text = await ainput("請自由描述你想做的行動：")
             self.last_action_id = "free_action"
             self.last_free_text = free_text
-            self.state.log += f"\n[自由行動] {free_text}\n"
+            self.add_log(f"\n[自由行動] {free_text}\n")
             return
 
         # 否則是一般 LLM 行動
         self.last_action_id = cid
         self.last_free_text = ""
-        self.state.log += f"\n[選項] {chosen['text']}\n"
+        self.add_log(f"\n[選項] {chosen['text']}\n")
 
     # ---------- 更新 State：不接受 LLM 改 location ----------
 
     def apply_state_update(self, hint: dict, quiz_result: str | None):
         if not isinstance(hint, dict):
             hint = {}
+        self._apply_state_update(self.state, hint, quiz_result)
 
-        # 完全忽略 hint["location"]，避免 LLM 瞬間移動
-        hint.pop("location", None)
-
-        chapter = hint.get("chapter")
-        if chapter:
-            self.state.chapter = int(chapter)
-
-        robot_parts = hint.get("robot_parts") or {}
-        for k in self.state.robot_parts.keys():
-            if k in robot_parts and isinstance(robot_parts[k], bool):
-                self.state.robot_parts[k] = robot_parts[k]
-
-        flags = hint.get("flags") or {}
-        for k, v in flags.items():
-            self.state.flags[k] = v
-
-        inv_add = hint.get("inventory_add") or []
-        for item in inv_add:
-            if item not in self.state.inventory:
-                self.state.inventory.append(item)
-
-        danger_delta = int(hint.get("danger_delta") or 0)
-        self.state.danger_level = max(0, min(100, self.state.danger_level + danger_delta))
+    # ---------- 日誌：最近回合保留原文，較早的併進摘要 ----------
 
-        knowledge_delta = int(hint.get("knowledge_delta") or 0)
-        self.state.knowledge_score += knowledge_delta
+    def add_log(self, text: str, new_turn: bool = False):
+        # 只有回合被移出視窗時才合併（先前失敗的也一起重試），不是每行日誌都打 API
+        evicted = self.state.append_log(text, new_turn)
+        if evicted and (self._fold_task is None or self._fold_task.done()):
+            self._fold_task = asyncio.create_task(self._fold_pending_log())
 
-        # quiz 額外處理
-        if quiz_result == "correct":
-            self.state.knowledge_score += 1
-        elif quiz_result == "wrong":
-            self.state.hp -= 1
-
-        hp_delta = int(hint.get("hp_delta") or 0)
-        self.state.hp += hp_delta
-
-        # 升級規則（簡單版）
-        if self.state.knowledge_score in (3, 6):
-            self.state.level += 1
+    async def _fold_pending_log(self):
+        instruction = (
+            "請把「新的遊戲歷程」併入「目前摘要」，輸出一段精簡的中文摘要，"
+            "保留重要事件、取得的道具，以及學到的機器人相關知識。"
+        )
+        while self.state.pending_fold:
+            n = len(self.state.pending_fold)
+            chunk = "".join(self.state.pending_fold)
+            prompt = (
+                f"{instruction}\n\n目前摘要：\n{self.state.running_summary}"
+                f"\n\n新的遊戲歷程：\n{chunk}"
+            )
+            try:
+                summary = await self.gpt.run_async(prompt, max_tokens=400)
+            except Exception as e:
+                # 原文留在 pending_fold，下次再併
+                logger.error(f"Log folding failed: {e}")
+                return
+            self.state.running_summary = _NEWLINES_RE.sub("\n", summary).strip()
+            del self.state.pending_fold[:n]
 
     # ---------- 結局 & 摘要 ----------
 
-    def do_ending(self):
+    async def do_ending(self):
         if self.state.is_win:
             ending = self.prompts.get("ending", "你完成了求生機器人，走向未知世界。")
-            input(ending + "\n(按 ENTER 生成旅程總結)... ")
-            self.state.log += "\n[Ending]\n" + ending + "\n"
+            await ainput(ending + "\n(按 ENTER 生成旅程總結)... ")
+            self.add_log("\n[Ending]\n" + ending + "\n")
         elif self.state.is_game_over:
             text = "你在這座末日實驗大樓中失去了行動能力。\n也許下一次，你能做出更好的選擇。"
-            input(text + "\n(按 ENTER 生成旅程總結)... ")
-            self.state.log += "\n[Game Over]\n" + text + "\n"
+            await ainput(text + "\n(按 ENTER 生成旅程總結)... ")
+            self.add_log("\n[Game Over]\n" + text + "\n")
         else:
             text = "你暫時離開了這座實驗大樓。"
-            input(text + "\n(按 ENTER 生成旅程總結)... ")
-            self.state.log += "\n[Exit]\n" + text + "\n"
+            await ainput(text + "\n(按 ENTER 生成旅程總結)... ")
+            self.add_log("\n[Exit]\n" + text + "\n")
 
         # 摘要：用同一個 model 生成
-        story = re.sub(r"\n+", "\n", self.state.log).strip()
+        # 等背景的摘要合併跑完；失敗的部分會以原文留在 log 裡
+        if self._fold_task is not None:
+            await self._fold_task
+        story = _NEWLINES_RE.sub("\n", self.state.log).strip()
         instruction = (
             "請將以下遊戲歷程整理成一篇中文短文，約 15~25 句話，"
             "描述玩家在末日機器人實驗大樓中的冒險，以及學到的機器人相關知識。"
         )
+        # 固定的指示放最前面、歷程放最後，共同前綴才吃得到 prompt caching
         prompt = f"{instruction}\n\n遊戲歷程：\n{story}"
+
+        # 先把原始歷程寫進去當暫時的總結，batch 完成後再覆寫
+        pending_file = self.summary_file + ".batch"
+        if os.path.exists(pending_file):
+            os.remove(pending_file)
+        write_txt(self.summary_file, story, write_log=True)
+
         try:
-            summary = self.gpt.run(prompt, max_tokens=800)
+            custom_id = os.path.splitext(os.path.basename(self.summary_file))[0]
+            batch_id = await asyncio.to_thread(
+                self.gpt.submit_batch, custom_id, prompt, max_tokens=800
+            )
+            print_box(f"旅程總結生成中，最多等待 {self.summary_batch_wait} 秒……")
+            summary = await self.wait_summary_batch(batch_id)
         except Exception as e:
-            logger.error(f"Summary generation failed: {e}")
-            summary = story
-
-        summary = re.sub(r"\n+", "\n", summary).strip()
-        write_txt(self.summary_file, summary, write_log=True)
-        print_box("本次旅程總結：\n" + summary)
-        input("\n(按 ENTER 結束遊戲)... ")
+            logger.warning(f"Summary batch failed, fallback to direct call: {e}")
+            batch_id = ""
+            try:
+                summary = await self.gpt.run_async(prompt, max_tokens=800)
+            except Exception as e:
+                logger.error(f"Summary generation failed: {e}")
+                summary = story
+
+        if summary is None:
+            # batch 還沒跑完：記下 batch id，下次啟動遊戲時補寫
+            write_json(pending_file, {"batch_id": batch_id}, write_log=True)
+            print_box(
+                "旅程總結仍在生成中，完成後會寫入 "
+                f"{self.summary_file}（下次啟動遊戲時更新）。"
+            )
+        else:
+            summary = _NEWLINES_RE.sub("\n", summary).strip()
+            write_txt(self.summary_file, summary, write_log=True)
+            print_box("本次旅程總結：\n" + summary)
+        await ainput("\n(按 ENTER 結束遊戲)... ")
+
+    async def wait_summary_batch(self, batch_id: str):
+        # 指數退避輪詢，超過 summary_batch_wait 秒就回傳 None
+        delay = 2
+        waited = 0
+        while waited < self.summary_batch_wait:
+            step = min(delay, self.summary_batch_wait - waited)
+            await asyncio.sleep(step)
+            waited += step
+            summary = await asyncio.to_thread(self.gpt.fetch_batch, batch_id)
+            if summary is not None:
+                return summary
+            delay = min(delay * 2, 30)
+        return None
+
+    def collect_pending_summaries(self):
+        # 上次沒等到的 batch 摘要：完成了就覆寫 summary 檔
+        for i in range(self.max_saves):
+            summary_file = os.path.join(self.output_dir, f"summary_{i + 1}.txt")
+            pending_file = summary_file + ".batch"
+            if not os.path.exists(pending_file):
+                continue
+            batch_id = read_json(pending_file)["batch_id"]
+            try:
+                summary = self.gpt.fetch_batch(batch_id)
+            except Exception as e:
+                logger.error(f"Summary batch {batch_id} failed: {e}")
+                os.remove(pending_file)
+                continue
+            if summary is None:
+                continue
+            summary = _NEWLINES_RE.sub("\n", summary).strip()
+            write_txt(summary_file, summary, write_log=True)
+            os.remove(pending_file)
 
 
 # ========== main ==========
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--config_file", type=str, default="config.json")
     args = parser.parse_args()
 
     # 要你輸入 sk- 的 key
-    openai.api_key = input("OpenAI API Key: ").strip()
+    api_key = input("OpenAI API Key: ").strip()
+
+    # 先讓玩家看到提示，拿到 key 之後才載入 openai
+    import openai
+    openai.api_key = api_key
+    # 摘要 batch 的上傳 / 建立 / 輪詢 / 下載都走 openai.requestssession
+    openai.requestssession = make_requests_session()
 
     cfg = Config(args.config_file)
     game = Game(cfg)
-    game.run_start()
+    try:
+        game.run_start()
+    except KeyboardInterrupt:
+        # ainput 的 daemon thread 可能還卡在 stdin 上：不等它，直接結束
+        print()
+        sys.stdout.flush()
+        os._exit(130)
 
 
 if __name__ == "__main__":